@@ -1,16 +1,61 @@
-from storage.object import ObjectStore
+import asyncio
+import contextlib
+
+from storage.object import ObjectStore, STREAM_CHUNK_SIZE
+from storage.db import (
+    PRAGMAS, SQL_CREATE, SQL_COPY, SQL_PUT, SQL_PUT_ZEROBLOB, SQL_GET,
+    SQL_ROWID, SQL_EXISTS, SQL_DELETE, SQL_CLEAR, SQL_TABLE_DEF,
+    declares_without_rowid, keys_query
+)
 
 import aiosqlite
 
+# number of rows fetched from the database thread per round-trip when listing keys
+KEYS_BATCH_SIZE = 1000
+
 class AsyncSqliteStore(ObjectStore):
-    def __init__(self, db_path):
+    def __init__(self, db_path, without_rowid=False):
+        """ without_rowid is as for SqliteStore """
         self.db_path = db_path
+        self.without_rowid = without_rowid
         self.conn = None
+        self._write_lock = asyncio.Lock()
 
     async def open(self):
-        self.conn = await aiosqlite.connect(self.db_path)
-        await self.conn.execute('CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, data BLOB)')
+        self.conn = await aiosqlite.connect(self.db_path, cached_statements=256)
+        if self.db_path != ':memory:':
+            await self.conn.execute('PRAGMA journal_mode=WAL')
+        for pragma in PRAGMAS:
+            await self.conn.execute(pragma)
+        options = ' WITHOUT ROWID' if self.without_rowid else ''
+        await self.conn.execute(SQL_CREATE.format(table='objects', options=options))
         await self.conn.commit()
+        cursor = await self.conn.execute(SQL_TABLE_DEF)
+        row = await cursor.fetchone()
+        if row is not None:
+            self.without_rowid = declares_without_rowid(row[0])
+
+    @contextlib.asynccontextmanager
+    async def _transaction(self):
+        """ run the body in a transaction, committed if it succeeds and rolled back if not.
+        the connection can only have one transaction open, so writes take turns """
+        async with self._write_lock:
+            await self.conn.execute('BEGIN')
+            try:
+                yield
+            except BaseException:
+                await self.conn.rollback()
+                raise
+            await self.conn.commit()
+
+    async def migrate_without_rowid(self):
+        """ rebuild an existing objects table as a WITHOUT ROWID table """
+        async with self._transaction():
+            await self.conn.execute(SQL_CREATE.format(table='objects_new', options=' WITHOUT ROWID'))
+            await self.conn.execute(SQL_COPY)
+            await self.conn.execute('DROP TABLE objects')
+            await self.conn.execute('ALTER TABLE objects_new RENAME TO objects')
+        self.without_rowid = True
 
     async def close(self):
         await self.conn.close()
@@ -24,31 +69,89 @@ class AsyncSqliteStore(ObjectStore):
         await self.close()
 
     async def put(self, key, data):
-        await self.conn.execute('INSERT OR REPLACE INTO objects (key, data) VALUES (?, ?)', (key, data))
-        await self.conn.commit()
+        async with self._transaction():
+            await self.conn.execute(SQL_PUT, (key, data))
+
+    async def put_many(self, items):
+        async with self._transaction():
+            await self.conn.executemany(SQL_PUT, items)
 
     async def get(self, key):
-        cursor = await self.conn.execute('SELECT data FROM objects WHERE key = ?', (key,))
+        cursor = await self.conn.execute(SQL_GET, (key,))
         row = await cursor.fetchone()
         if row is None:
             raise KeyError(key)
         return row[0]
+
+    # the incremental blob API needs a rowid, and sqlite3 objects must be used
+    # on aiosqlite's connection thread, hence the use of Connection._execute
+
+    async def get_stream(self, key, chunk_size=STREAM_CHUNK_SIZE):
+        """ yield the data associated with the key in chunks, without reading it all into memory """
+        if self.without_rowid:
+            data = await self.get(key)
+            for i in range(0, len(data), chunk_size):
+                yield data[i:i+chunk_size]
+            return
+        cursor = await self.conn.execute(SQL_ROWID, (key,))
+        row = await cursor.fetchone()
+        if row is None:
+            raise KeyError(key)
+        blob = await self.conn._execute(self.conn._conn.blobopen, 'objects', 'data', row[0], readonly=True)
+        try:
+            while True:
+                chunk = await self.conn._execute(blob.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            await self.conn._execute(blob.close)
+
+    async def put_stream(self, key, chunks, size):
+        """ store size bytes from the async iterable chunks, writing them into place
+        without assembling the whole value in memory """
+        if self.without_rowid:
+            data = b''.join([chunk async for chunk in chunks])
+            if len(data) != size:
+                raise ValueError(f'expected {size} bytes for {key}, got {len(data)}')
+            await self.put(key, data)
+            return
+        async with self._transaction():
+            cursor = await self.conn.execute(SQL_PUT_ZEROBLOB, (key, size))
+            blob = await self.conn._execute(self.conn._conn.blobopen, 'objects', 'data', cursor.lastrowid)
+            try:
+                written = 0
+                async for chunk in chunks:
+                    if written + len(chunk) > size:
+                        raise ValueError(f'more than {size} bytes provided for {key}')
+                    await self.conn._execute(blob.write, chunk)
+                    written += len(chunk)
+            finally:
+                await self.conn._execute(blob.close)
+            if written != size:
+                raise ValueError(f'expected {size} bytes for {key}, got {written}')
     
     async def exists(self, key):
-        cursor = await self.conn.execute('SELECT 1 FROM objects WHERE key = ?', (key,))
-        return (await cursor.fetchone()) is not None
+        cursor = await self.conn.execute(SQL_EXISTS, (key,))
+        row = await cursor.fetchone()
+        return bool(row[0])
     
     async def delete(self, key):
-        await self.conn.execute('DELETE FROM objects WHERE key = ?', (key,))
-        await self.conn.commit()
+        async with self._transaction():
+            await self.conn.execute(SQL_DELETE, (key,))
 
-    async def keys(self):
-        cursor = await self.conn.execute('SELECT key FROM objects')
-        async for row in cursor:
-            yield row[0]
+    async def keys(self, prefix=''):
+        cursor = await self.conn.execute(*keys_query(prefix))
+        try:
+            while True:
+                rows = await cursor.fetchmany(KEYS_BATCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row[0]
+        finally:
+            await cursor.close()
     
     async def clear(self):
-        await self.conn.execute('DELETE FROM objects')
-        await self.conn.commit()
-
-
+        async with self._transaction():
+            await self.conn.execute(SQL_CLEAR)
@@ -1,23 +1,185 @@
 import os
+import shutil
+import struct
+import asyncio
+import itertools
+import contextlib
 
 import aiofiles
 
 from aiofiles import os as aios
 
 from storage.object import ObjectStore
-from storage.fs import hashpath
+from storage.aioutils import async_put_many
+from storage.fs import hashpath, hashdir_store_depth, walk_files, MAX_ENSURED_DIRS
+
+
+def _copy_file(src_path, dst_path):
+    # let the kernel copy the data (in place on reflink-capable filesystems)
+    # and fall back to shutil, which uses sendfile where available
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                return
+        except FileNotFoundError:
+            raise
+        except OSError:
+            pass
+    shutil.copyfile(src_path, dst_path)
+
+
+# temporary files are written next to their destination and renamed into place
+_TMP_PREFIX = '.tmp-'
+
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+def _write_file(path, data):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def _remove_tmp_files(moves):
+    # files that were already moved into place are no longer there
+    for tmp_path, _ in moves:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+
+
+def _commit_files(moves):
+    """ durably move each (tmp_path, path) into place, syncing each
+    parent directory once for the whole batch. if that fails, the
+    temporary files that weren't moved are removed """
+    try:
+        for tmp_path, _ in moves:
+            fd = os.open(tmp_path, os.O_RDONLY)
+            try:
+                _fdatasync(fd)
+            finally:
+                os.close(fd)
+        for tmp_path, path in moves:
+            os.replace(tmp_path, path)
+    except BaseException:
+        _remove_tmp_files(moves)
+        raise
+    for dirpath in {os.path.dirname(path) for _, path in moves}:
+        fd = os.open(dirpath, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+# number of keys listed per trip to the worker thread
+KEYS_BATCH_SIZE = 1000
 
 
 class AsyncFilesystemStore(ObjectStore):
-    def __init__(self, root_path):
+    """
+    Stores each object in a file named by its key.
+
+    Objects are written to a temporary file and renamed into place, so readers
+    never see a partially written object. Every put pays for the rename, including
+    with durability 'none'. durability controls when data reaches the disk:
+
+    - 'none': no fsync; fastest, but recent puts may be lost on a crash
+    - 'sync': fsync the file and its directory before each put returns
+    - 'batch': like 'sync', but puts arriving within batch_delay seconds of each other
+      are committed together. Each file is still synced, but each directory is synced
+      once per batch, and the whole batch is synced in one trip to a worker thread
+    """
+    def __init__(self, root_path, durability='none', batch_delay=0.005):
+        if durability not in ('none', 'sync', 'batch'):
+            raise ValueError(f'unknown durability {durability!r}')
         self.root_path = root_path
+        self._root_prefix = os.path.join(root_path, '')
+        self.durability = durability
+        self.batch_delay = batch_delay
+        self._tmp_counter = itertools.count()
+        self._batch = None
+        self._batch_task = None
+        self._ensured_dirs = set()
 
     def _path(self, key):
-        return os.path.join(self.root_path, key)
+        return self._root_prefix + key
+
+    async def _ensure_dir(self, path):
+        dirpath = os.path.dirname(path)
+        if dirpath not in self._ensured_dirs:
+            await aios.makedirs(dirpath, exist_ok=True)
+            if len(self._ensured_dirs) >= MAX_ENSURED_DIRS:
+                self._ensured_dirs.clear()
+            self._ensured_dirs.add(dirpath)
+
+    def _tmp_path(self, path):
+        dirpath, filename = os.path.split(path)
+        return os.path.join(dirpath, f'{_TMP_PREFIX}{os.getpid()}-{next(self._tmp_counter)}-{filename}')
+
+    async def _commit(self, tmp_path, path):
+        if self.durability == 'none':
+            try:
+                await aios.replace(tmp_path, path)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.remove(tmp_path)
+                raise
+        elif self.durability == 'sync':
+            await asyncio.to_thread(_commit_files, [(tmp_path, path)])
+        else:
+            if self._batch is None:
+                self._batch = ([], asyncio.get_running_loop().create_future())
+                # keep a reference so the task isn't garbage collected while it sleeps
+                self._batch_task = asyncio.create_task(self._commit_batch())
+            moves, committed = self._batch
+            moves.append((tmp_path, path))
+            await asyncio.shield(committed)
+
+    async def _commit_batch(self):
+        await asyncio.sleep(self.batch_delay)
+        moves, committed = self._batch
+        self._batch = None
+        try:
+            await asyncio.to_thread(_commit_files, moves)
+        except Exception as e:
+            committed.set_exception(e)
+        else:
+            committed.set_result(None)
+
+    async def _put_file(self, path, data):
+        tmp_path = self._tmp_path(path)
+        try:
+            await asyncio.to_thread(_write_file, tmp_path, data)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+        await self._commit(tmp_path, path)
 
     async def put(self, key, data):
-        async with aiofiles.open(self._path(key), 'wb') as f:
-            await f.write(data)
+        path = self._path(key)
+        await self._ensure_dir(path)
+        try:
+            await self._put_file(path, data)
+        except FileNotFoundError:
+            # the directory was removed after it was created
+            self._ensured_dirs.discard(os.path.dirname(path))
+            await self._ensure_dir(path)
+            await self._put_file(path, data)
+
+    async def put_many(self, items):
+        await asyncio.gather(*(self.put(key, data) for key, data in items))
 
     async def get(self, key):
         try:
@@ -25,6 +187,22 @@ class AsyncFilesystemStore(ObjectStore):
                 return await f.read()
         except FileNotFoundError:
             raise KeyError(key)
+
+    async def copy_from(self, other_store, key):
+        """ copy the object for key from other_store into this store.
+        copies between filesystem stores are done by the kernel without
+        reading the data into memory. """
+        if not isinstance(other_store, AsyncFilesystemStore):
+            await self.put(key, await other_store.get(key))
+            return
+        path = self._path(key)
+        await self._ensure_dir(path)
+        tmp_path = self._tmp_path(path)
+        try:
+            await asyncio.to_thread(_copy_file, other_store._path(key), tmp_path)
+        except FileNotFoundError:
+            raise KeyError(key)
+        await self._commit(tmp_path, path)
         
     async def exists(self, key):
         return await aios.path.exists(self._path(key))
@@ -37,25 +215,181 @@ class AsyncFilesystemStore(ObjectStore):
             raise KeyError(key)
 
     async def keys(self):
-        for dirpath, _, filenames in os.walk(self.root_path):
-            for filename in filenames:
-                yield os.path.relpath(os.path.join(dirpath, filename), self.root_path)
+        # walk the directory tree in a worker thread so the event loop isn't blocked
+        walk = walk_files(self.root_path, skip_prefix=_TMP_PREFIX)
+        while True:
+            batch = await asyncio.to_thread(list, itertools.islice(walk, KEYS_BATCH_SIZE))
+            if not batch:
+                break
+            for key in batch:
+                yield key
     
 
 class AsyncHashdirStore(AsyncFilesystemStore):
-    def __init__(self, root_path, width=2, depth=3):
-        self.root_path = root_path
+    def __init__(self, root_path, width=2, depth=None, durability='none', batch_delay=0.005, expected_keys=None):
+        """ width, depth and expected_keys are as for HashdirStore """
+        super().__init__(root_path, durability, batch_delay)
         self.width = width
-        self.depth = depth
+        self.depth = hashdir_store_depth(root_path, width, depth, expected_keys)
 
     def _path(self, key):
-        return os.path.join(self.root_path, hashpath(key, self.width, self.depth))
-    
-    async def put(self, key, data):
-        path = self._path(key)
-        await aios.makedirs(os.path.dirname(path), exist_ok=True)
-        async with aiofiles.open(path, 'wb') as f:
-            await f.write(data)
+        return self._root_prefix + hashpath(key, self.width, self.depth)
 
     def keys(self):
         raise NotImplementedError("HashdirStore does not support listing keys")
+
+
+# (segment, offset, length) of an object in an AsyncBufferedWriteStore
+_LOCATION = struct.Struct('<QQQ')
+
+
+def _append(path, data):
+    with open(path, 'ab') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class AsyncBufferedWriteStore(ObjectStore):
+    """
+    Buffers puts in memory and appends them to large segment files, so that many
+    small objects cost one write and one fsync per flush rather than a file each.
+
+    The location of each object is kept in memory and mirrored to index_store
+    (for example an AsyncSqliteStore) with put_many whenever the buffer is flushed.
+    The buffer is flushed when it reaches flush_bytes and every flush_interval seconds.
+    Objects put since the last flush are lost if the process exits without closing the store.
+
+    Segments are rotated at segment_size bytes, so a segment is larger than that by
+    less than the size of its last object. Space used by deleted or overwritten
+    objects is not reclaimed.
+
+    Use as an async context manager to load the index and run the background flusher.
+    """
+    def __init__(self, root_path, index_store, flush_bytes=1024*1024, flush_interval=1.0, segment_size=64*1024*1024):
+        self.root_path = root_path
+        self.index_store = index_store
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.segment_size = segment_size
+        self.index = {}
+        self.pending = []
+        self.buffer = bytearray()
+        self.segment = 0
+        self.segment_offset = 0 # end of the current segment, including buffered data
+        self.flushed_offset = 0 # end of the data written to the current segment file
+        self.flusher = None
+        self._stop_flusher = None
+        self._flush_lock = asyncio.Lock()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.root_path, f'{segment:08d}.seg')
+
+    async def open(self):
+        await aios.makedirs(self.root_path, exist_ok=True)
+        async for key in self.index_store.keys():
+            self.index[key] = _LOCATION.unpack(await self.index_store.get(key))
+        segments = [int(name[:-4]) for name in os.listdir(self.root_path) if name.endswith('.seg')]
+        # always start a fresh segment
+        self.segment = max(segments, default=0) + 1
+        self.segment_offset = 0
+        self.flushed_offset = 0
+        self._stop_flusher = asyncio.Event()
+        self.flusher = asyncio.create_task(self._flush_periodically())
+
+    async def close(self):
+        if self.flusher is not None:
+            # let the flusher finish any flush in progress rather than cancelling it
+            self._stop_flusher.set()
+            try:
+                await self.flusher
+            finally:
+                self.flusher = None
+        await self.flush()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _flush_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._stop_flusher.wait(), self.flush_interval)
+                return
+            except asyncio.TimeoutError:
+                await self.flush()
+
+    async def flush(self):
+        """ write buffered objects to the current segment and record their locations in the index store """
+        # shielded, because a flush interrupted between writing the buffer and
+        # recording the locations would lose the index entries and rewrite the data
+        await asyncio.shield(self._flush())
+
+    async def _flush(self):
+        async with self._flush_lock:
+            size = len(self.buffer)
+            pending, self.pending = self.pending, []
+            if size:
+                # puts may append to the buffer while this write is in progress,
+                # so write a copy rather than a view that would pin its size
+                await asyncio.to_thread(_append, self._segment_path(self.segment), self.buffer[:size])
+                del self.buffer[:size]
+                self.flushed_offset += size
+            # skip entries for keys that have since been overwritten or deleted
+            items = [(key, _LOCATION.pack(*location)) for key, location in pending if self.index.get(key) == location]
+            if items:
+                await async_put_many(self.index_store, items)
+            if not self.buffer and self.segment_offset >= self.segment_size:
+                self.segment += 1
+                self.segment_offset = 0
+                self.flushed_offset = 0
+
+    async def put(self, key, data):
+        # once the current segment is full, nothing more is buffered for it:
+        # flush what is buffered, which starts the next segment
+        while self.segment_offset >= self.segment_size:
+            await self.flush()
+        location = (self.segment, self.segment_offset, len(data))
+        self.buffer += data
+        self.segment_offset += len(data)
+        self.index[key] = location
+        self.pending.append((key, location))
+        if len(self.buffer) >= self.flush_bytes:
+            await self.flush()
+
+    async def put_many(self, items):
+        for key, data in items:
+            await self.put(key, data)
+
+    async def get(self, key):
+        try:
+            segment, offset, length = self.index[key]
+        except KeyError:
+            raise KeyError(key)
+        if segment == self.segment and offset >= self.flushed_offset:
+            start = offset - self.flushed_offset
+            with memoryview(self.buffer) as view:
+                return view[start:start+length].tobytes()
+        async with aiofiles.open(self._segment_path(segment), 'rb') as f:
+            await f.seek(offset)
+            return await f.read(length)
+
+    async def exists(self, key):
+        return key in self.index
+
+    async def delete(self, key):
+        try:
+            del self.index[key]
+        except KeyError:
+            raise KeyError(key)
+        try:
+            await self.index_store.delete(key)
+        except KeyError:
+            pass # not flushed to the index store yet
+
+    async def keys(self):
+        for key in list(self.index):
+            yield key
@@ -1,5 +1,35 @@
+import asyncio
+import inspect
+
 from storage.object import ObjectStore
 
+
+async def async_put_many(store, items):
+    """ store each (key, data) pair in items in the async store, with the store's
+    own put_many if it defines one. ObjectStore's default put_many is synchronous,
+    so for stores that don't override it the items are put one at a time. """
+    if inspect.iscoroutinefunction(store.put_many):
+        await store.put_many(items)
+    else:
+        for key, data in items:
+            await store.put(key, data)
+
+
+async def _first(aws):
+    """ return the first non-None result of the awaitables, in order of completion,
+    cancelling the rest. returns None if every result is None. """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            result = await next_done
+            if result is not None:
+                return result
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
 # Store implemtations that combine multiple stores in some way
 
 class AsyncFanoutStore(ObjectStore):
@@ -7,59 +37,129 @@ class AsyncFanoutStore(ObjectStore):
         self.children = children
 
     async def put(self, key, data):
-        for child in self.children:
-            await child.put(key, data)
+        await asyncio.gather(*(child.put(key, data) for child in self.children))
+
+    async def put_many(self, items):
+        items = list(items)
+        await asyncio.gather(*(async_put_many(child, items) for child in self.children))
+
+    async def _child_with(self, child, key):
+        return child if await child.exists(key) else None
 
     async def get(self, key):
         for child in self.children:
-            if await child.exists(key):
+            try:
                 return await child.get(key)
+            except KeyError:
+                continue
         raise KeyError(key)
 
     async def exists(self, key):
-        for child in self.children:
-            if await child.exists(key):
-                return True
-        return False
+        return await _first(self._child_with(child, key) for child in self.children) is not None
+
+    async def _delete(self, child, key):
+        try:
+            await child.delete(key)
+        except KeyError:
+            pass
 
     async def delete(self, key):
-        for child in self.children:
-            if await child.exists(key):
-                await child.delete(key)
+        await asyncio.gather(*(self._delete(child, key) for child in self.children))
 
     async def keys(self):
-        keys = set()
-        for child in self.children:
+        done = object()
+        queue = asyncio.Queue(maxsize=1000)
+
+        async def list_child(child):
             async for key in child.keys():
-                keys.add(key)
-        for key in keys:
-            yield key
+                await queue.put(key)
+
+        async def list_children():
+            try:
+                await asyncio.gather(*(list_child(child) for child in self.children))
+            finally:
+                await queue.put(done)
+
+        producer = asyncio.ensure_future(list_children())
+        seen = set()
+        try:
+            while True:
+                key = await queue.get()
+                if key is done:
+                    break
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+            await producer # propagate any errors from the children
+        finally:
+            producer.cancel()
 
 
 class AsyncCachingStore(ObjectStore):
-    def __init__(self, main_store, cache_store):
+    def __init__(self, main_store, cache_store, index_keys=False):
+        """
+        If index_keys is True, the keys of main_store are listed in the background
+        into an in-memory set of key hashes, so that exists() can answer cache misses
+        for absent keys without a round-trip to main_store. main_store should then only
+        be modified through this store.
+        """
         self.main_store = main_store
         self.cache_store = cache_store
+        self.index_keys = index_keys
+        self._key_hashes = set()
+        self._index_task = None
+        self._index_ready = False
+
+    async def _build_index(self):
+        try:
+            async for key in self.main_store.keys():
+                self._key_hashes.add(hash(key))
+        except NotImplementedError:
+            return # main_store can't list keys, so always ask it
+        self._index_ready = True
 
     async def put(self, key, data):
         await self.main_store.put(key, data)
+        self._key_hashes.add(hash(key))
         await self.cache_store.put(key, data)
 
+    async def put_many(self, items):
+        items = list(items)
+        await async_put_many(self.main_store, items)
+        self._key_hashes.update(hash(key) for key, _ in items)
+        await async_put_many(self.cache_store, items)
+
     async def get(self, key):
-        if await self.cache_store.exists(key):
+        try:
             return await self.cache_store.get(key)
-        else:
-            data = await self.main_store.get(key)
-            await self.cache_store.put(key, data)
-            return data
+        except KeyError:
+            pass
+        data = await self.main_store.get(key)
+        await self.cache_store.put(key, data)
+        return data
 
     async def exists(self, key):
-        return await self.cache_store.exists(key) or await self.main_store.exists(key)
+        if await self.cache_store.exists(key):
+            return True
+        if self.index_keys and self._index_task is None:
+            self._index_task = asyncio.create_task(self._build_index())
+        elif self._index_task is not None and self._index_task.done() and self._index_task.exception():
+            # listing main_store failed: report it, and try again on the next call
+            task, self._index_task = self._index_task, None
+            raise task.exception()
+        if self._index_ready and hash(key) not in self._key_hashes:
+            return False
+        # the index may give false positives, so confirm with main_store
+        return await self.main_store.exists(key)
 
     async def delete(self, key):
         await self.main_store.delete(key)
-        if await self.cache_store.exists(key):
+        # other keys may have the same hash, so it stays in the index;
+        # that only costs a round-trip to main_store for this key
+        try:
             await self.cache_store.delete(key)
+        except KeyError:
+            pass
 
     async def keys(self):
         async for key in self.main_store.keys():
@@ -69,30 +169,124 @@ class AsyncCachingStore(ObjectStore):
         if key is None:
             async for cached_key in self.cache_store.keys():
                 await self.cache_store.delete(cached_key)
-        elif await self.cache_store.exists(key):
-            await self.cache_store.delete(key)
+        else:
+            try:
+                await self.cache_store.delete(key)
+            except KeyError:
+                pass
 
    
 # utility functions for multi-store actions
+
+# pending puts are buffered up to this many bytes and written with put_many
+BATCH_BYTES = 1024 * 1024
+
+
+class _PutBatch:
+    def __init__(self, store, max_bytes=BATCH_BYTES):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.items = []
+        self.size = 0
+        self.flush_lock = asyncio.Lock()
+
+    async def copy(self, from_store, key):
+        if hasattr(self.store, 'copy_from'):
+            # the destination store has its own fast path for copying
+            await self.store.copy_from(from_store, key)
+        else:
+            await self.put(key, await from_store.get(key))
+
+    async def put(self, key, data):
+        self.items.append((key, data))
+        self.size += len(data)
+        if self.size >= self.max_bytes:
+            await self.flush()
+
+    async def flush(self):
+        # swap the pending items out first so concurrent puts start a new batch,
+        # and write one batch at a time so that the store sees one put_many at once
+        items, self.items, self.size = self.items, [], 0
+        if items:
+            async with self.flush_lock:
+                await async_put_many(self.store, items)
+
+
+async def _for_each_key(keys, worker, concurrency):
+    """ run worker(key) for each key from the async iterable keys,
+    with at most concurrency workers in flight at once. """
+    done = object()
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def produce():
+        async for key in keys:
+            await queue.put(key)
+        for _ in range(concurrency):
+            await queue.put(done)
+
+    async def consume():
+        while True:
+            key = await queue.get()
+            if key is done:
+                return
+            await worker(key)
+
+    tasks = [asyncio.ensure_future(produce())]
+    tasks.extend(asyncio.ensure_future(consume()) for _ in range(concurrency))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
             
-async def async_copy_store(from_store, to_store, overwrite=True):
-    async for key in from_store.keys():
+async def async_copy_store(from_store, to_store, overwrite=True, concurrency=32):
+    batch = _PutBatch(to_store)
+
+    async def copy(key):
         if overwrite or not await to_store.exists(key):
-            await to_store.put(key, await from_store.get(key))
+            await batch.copy(from_store, key)
+
+    await _for_each_key(from_store.keys(), copy, concurrency)
+    await batch.flush()
 
 
-async def async_clear_store(store):
+async def async_clear_store(store, batch_size=1000):
+    if not hasattr(store, 'delete_many'):
+        async for key in store.keys():
+            await store.delete(key)
+        return
+    # the store can delete many keys per request
+    errors = {}
+    batch = []
     async for key in store.keys():
-        await store.delete(key)
+        batch.append(key)
+        if len(batch) >= batch_size:
+            errors.update(await store.delete_many(batch))
+            batch = []
+    if batch:
+        errors.update(await store.delete_many(batch))
+    if errors:
+        raise RuntimeError(f'failed to delete {len(errors)} keys, e.g. {next(iter(errors.items()))}')
+
 
+async def async_sync_stores(from_store, to_store, delete=False, concurrency=32):
+    batch = _PutBatch(to_store)
+    from_keys = set()
 
-async def async_sync_stores(from_store, to_store, delete=False):
-    async for key in from_store.keys():
+    async def copy(key):
+        if delete:
+            from_keys.add(key)
         # copy if necessary
         if not await to_store.exists(key):
-            await to_store.put(key, await from_store.get(key))
+            await batch.copy(from_store, key)
+
+    await _for_each_key(from_store.keys(), copy, concurrency)
+    await batch.flush()
     if delete:
         # remove keys from to_store that are not in from_store
-        async for key in to_store.keys():
-            if not await from_store.exists(key):
+        async def remove(key):
+            if key not in from_keys:
                 await to_store.delete(key)
+
+        await _for_each_key(to_store.keys(), remove, concurrency)
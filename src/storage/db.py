@@ -1,20 +1,112 @@
+import re
 import sqlite3
 
-from .object import ObjectStore
+from contextlib import contextmanager
+
+from .object import ObjectStore, STREAM_CHUNK_SIZE
+
+# connection settings for write throughput: WAL with synchronous=NORMAL
+# doesn't fsync on every commit, and readers don't block writers
+PRAGMAS = [
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=30000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-65536',
+]
+
+
+# statements are kept as constants so each one is prepared once and then
+# found in the connection's statement cache. AsyncSqliteStore uses them too
+SQL_CREATE = 'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, data BLOB){options}'
+SQL_COPY = 'INSERT INTO objects_new (key, data) SELECT key, data FROM objects'
+SQL_PUT = 'INSERT OR REPLACE INTO objects (key, data) VALUES (?, ?)'
+SQL_PUT_ZEROBLOB = 'INSERT OR REPLACE INTO objects (key, data) VALUES (?, zeroblob(?))'
+SQL_GET = 'SELECT data FROM objects WHERE key = ?'
+SQL_GET_MANY = 'SELECT key, data FROM objects WHERE key IN ({placeholders})'
+SQL_ROWID = 'SELECT rowid FROM objects WHERE key = ?'
+SQL_EXISTS = 'SELECT EXISTS(SELECT 1 FROM objects WHERE key = ? LIMIT 1)'
+SQL_EXISTS_MANY = 'SELECT key FROM objects WHERE key IN ({placeholders})'
+SQL_DELETE = 'DELETE FROM objects WHERE key = ?'
+SQL_KEYS = 'SELECT key FROM objects'
+SQL_KEYS_PREFIX = 'SELECT key FROM objects WHERE key >= ? ORDER BY key'
+SQL_KEYS_RANGE = 'SELECT key FROM objects WHERE key >= ? AND key < ? ORDER BY key'
+SQL_CLEAR = 'DELETE FROM objects'
+SQL_TABLE_DEF = "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'objects'"
+
+# maximum number of keys bound into one IN (...) query
+MANY_BATCH_SIZE = 500
+
+
+def declares_without_rowid(table_sql):
+    """ return whether a CREATE TABLE statement declares a WITHOUT ROWID table """
+    # table options follow the closing parenthesis of the column definitions
+    options = table_sql[table_sql.rfind(')') + 1:]
+    return re.search(r'\bWITHOUT\s+ROWID\b', options, re.IGNORECASE) is not None
+
+
+def keys_query(prefix):
+    """ return the query and parameters listing the keys that start with prefix.
+    a prefix becomes a range scan of the primary key index. """
+    if not prefix:
+        return SQL_KEYS, ()
+    # the upper bound is the smallest string greater than every key with the prefix
+    upper = prefix.rstrip('\U0010ffff')
+    if not upper:
+        return SQL_KEYS_PREFIX, (prefix,)
+    following = ord(upper[-1]) + 1
+    if 0xD800 <= following <= 0xDFFF:
+        following = 0xE000 # surrogates can't be encoded
+    return SQL_KEYS_RANGE, (prefix, upper[:-1] + chr(following))
 
 
 class SqliteStore(ObjectStore):
-    def __init__(self, db_path):
+    def __init__(self, db_path, without_rowid=False):
+        """ if without_rowid is True, a new objects table is created WITHOUT ROWID, which suits
+        small values. an existing table keeps its layout; see migrate_without_rowid """
         self.db_path = db_path
+        self.without_rowid = without_rowid
+        options = ' WITHOUT ROWID' if without_rowid else ''
         with sqlite3.connect(db_path) as conn:
-            conn.execute('CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, data BLOB)')
+            conn.execute(SQL_CREATE.format(table='objects', options=options))
 
     def open(self):
-        self.conn = sqlite3.connect(self.db_path)
+        # autocommit unless inside transaction()
+        self.conn = sqlite3.connect(self.db_path, isolation_level=None, cached_statements=256)
+        if self.db_path != ':memory:':
+            self.conn.execute('PRAGMA journal_mode=WAL')
+        for pragma in PRAGMAS:
+            self.conn.execute(pragma)
+        row = self.conn.execute(SQL_TABLE_DEF).fetchone()
+        if row is not None:
+            self.without_rowid = declares_without_rowid(row[0])
 
     def close(self):
         self.conn.close()
 
+    def migrate_without_rowid(self):
+        """ rebuild an existing objects table as a WITHOUT ROWID table """
+        with self.transaction():
+            self.conn.execute(SQL_CREATE.format(table='objects_new', options=' WITHOUT ROWID'))
+            self.conn.execute(SQL_COPY)
+            self.conn.execute('DROP TABLE objects')
+            self.conn.execute('ALTER TABLE objects_new RENAME TO objects')
+        self.without_rowid = True
+
+    @contextmanager
+    def transaction(self):
+        """ group the puts and deletes made inside the with block into a
+        single transaction, committed on exit or rolled back on error """
+        if self.conn.in_transaction:
+            yield self # already in a transaction
+            return
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield self
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
     def __enter__(self):
         self.open()
         return self
@@ -23,24 +115,93 @@ class SqliteStore(ObjectStore):
         self.close()
 
     def put(self, key, data):
-        self.conn.execute('INSERT OR REPLACE INTO objects (key, data) VALUES (?, ?)', (key, data))
-        self.conn.commit()
+        self.conn.execute(SQL_PUT, (key, data))
+
+    def put_many(self, items):
+        with self.transaction():
+            self.conn.executemany(SQL_PUT, items)
 
     def get(self, key):
-        cursor = self.conn.execute('SELECT data FROM objects WHERE key = ?', (key,))
+        cursor = self.conn.execute(SQL_GET, (key,))
         row = cursor.fetchone()
         if row is None:
             raise KeyError(key)
         return row[0]
+
+    def _rowid(self, key):
+        row = self.conn.execute(SQL_ROWID, (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def get_stream(self, key, chunk_size=STREAM_CHUNK_SIZE):
+        """ yield the data associated with the key in chunks, without reading it all into memory """
+        if self.without_rowid: # the incremental blob API needs a rowid
+            data = self.get(key)
+            for i in range(0, len(data), chunk_size):
+                yield data[i:i+chunk_size]
+            return
+        with self.conn.blobopen('objects', 'data', self._rowid(key), readonly=True) as blob:
+            while True:
+                chunk = blob.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def get_into(self, key, buf, chunk_size=STREAM_CHUNK_SIZE):
+        """ read the data associated with the key into the writable buffer buf,
+        returning its length. buf can be reused between calls. """
+        view = memoryview(buf)
+        length = 0
+        for chunk in self.get_stream(key, chunk_size):
+            if length + len(chunk) > len(view):
+                raise ValueError(f'buffer too small for {key}')
+            view[length:length+len(chunk)] = chunk
+            length += len(chunk)
+        return length
+
+    def put_stream(self, key, chunks, size):
+        """ store size bytes from the iterable chunks, writing them into place
+        without assembling the whole value in memory """
+        if self.without_rowid:
+            data = b''.join(chunks)
+            if len(data) != size:
+                raise ValueError(f'expected {size} bytes for {key}, got {len(data)}')
+            self.put(key, data)
+            return
+        with self.transaction():
+            cursor = self.conn.execute(SQL_PUT_ZEROBLOB, (key, size))
+            written = 0
+            with self.conn.blobopen('objects', 'data', cursor.lastrowid) as blob:
+                for chunk in chunks:
+                    if written + len(chunk) > size:
+                        raise ValueError(f'more than {size} bytes provided for {key}')
+                    blob.write(chunk)
+                    written += len(chunk)
+            if written != size:
+                raise ValueError(f'expected {size} bytes for {key}, got {written}')
+
+    def _select_many(self, sql, keys):
+        keys = list(keys)
+        for i in range(0, len(keys), MANY_BATCH_SIZE):
+            batch = keys[i:i+MANY_BATCH_SIZE]
+            yield from self.conn.execute(sql.format(placeholders=','.join('?' * len(batch))), batch)
+
+    def get_many(self, keys):
+        """ return a dict of the data for each of keys that exists in the store """
+        return dict(self._select_many(SQL_GET_MANY, keys))
     
     def exists(self, key):
-        cursor = self.conn.execute('SELECT 1 FROM objects WHERE key = ?', (key,))
-        return cursor.fetchone() is not None
+        cursor = self.conn.execute(SQL_EXISTS, (key,))
+        return bool(cursor.fetchone()[0])
+
+    def exists_many(self, keys):
+        """ return the set of keys that exist in the store """
+        return {key for key, in self._select_many(SQL_EXISTS_MANY, keys)}
     
     def delete(self, key):
-        self.conn.execute('DELETE FROM objects WHERE key = ?', (key,))
-        self.conn.commit()
+        self.conn.execute(SQL_DELETE, (key,))
 
-    def keys(self):
-        cursor = self.conn.execute('SELECT key FROM objects')
-        return [row[0] for row in cursor.fetchall()]
+    def keys(self, prefix=''):
+        for key, in self.conn.execute(*keys_query(prefix)):
+            yield key
@@ -1,30 +1,146 @@
 import os
+import io
+import math
+import shutil
 import hashlib
+import functools
 
-from storage.object import ObjectStore
+from storage.object import ObjectStore, STREAM_CHUNK_SIZE
+
+# directories known to exist are remembered so that puts don't repeat
+# the mkdir calls; the record is cleared when it grows past this size
+MAX_ENSURED_DIRS = 65536
+
+
+def walk_files(root_path, skip_prefix=None):
+    """ yield the paths of the files under root_path, relative to it,
+    skipping files whose names start with skip_prefix """
+    prefix_len = len(os.path.join(root_path, ''))
+    stack = [root_path]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue # like os.walk, skip directories that can't be listed
+        with entries:
+            for entry in entries:
+                if entry.is_dir():
+                    # like os.walk, don't descend into symlinked directories
+                    if not entry.is_symlink():
+                        stack.append(entry.path)
+                elif skip_prefix is None or not entry.name.startswith(skip_prefix):
+                    yield entry.path[prefix_len:]
 
 
 class FilesystemStore(ObjectStore):
     def __init__(self, root_path):
         self.root_path = root_path
+        self._root_prefix = os.path.join(root_path, '')
+        self._ensured_dirs = set()
 
     def _path(self, key):
-        return os.path.join(self.root_path, key)
+        return self._root_prefix + key
+
+    def _ensure_dir(self, path):
+        dirpath = os.path.dirname(path)
+        if dirpath not in self._ensured_dirs:
+            os.makedirs(dirpath, exist_ok=True)
+            if len(self._ensured_dirs) >= MAX_ENSURED_DIRS:
+                self._ensured_dirs.clear()
+            self._ensured_dirs.add(dirpath)
+
+    def _open_for_write(self, key):
+        path = self._path(key)
+        self._ensure_dir(path)
+        try:
+            return open(path, 'wb')
+        except FileNotFoundError:
+            # the directory was removed after it was created
+            self._ensured_dirs.discard(os.path.dirname(path))
+            self._ensure_dir(path)
+            return open(path, 'wb')
 
     def put(self, key, data):
-        os.makedirs(os.path.dirname(self._path(key)), exist_ok=True)
-        with open(self._path(key), 'wb') as f:
+        with self._open_for_write(key) as f:
             f.write(data)
 
+    def put_stream(self, key, chunks):
+        """ store the data from the iterable chunks without assembling it in memory """
+        with self._open_for_write(key) as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+    def put_file(self, key, src):
+        """ store the remaining contents of the binary file object src. when src is
+        a real file the data is copied by the kernel with sendfile where possible """
+        with self._open_for_write(key) as dst:
+            try:
+                # pipes and sockets have a file descriptor but no position to send from
+                src_fd = src.fileno()
+                start = src.tell()
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                src_fd = None
+            if src_fd is not None and hasattr(os, 'sendfile'):
+                offset = start
+                try:
+                    while True:
+                        sent = os.sendfile(dst.fileno(), src_fd, offset, STREAM_CHUNK_SIZE * 4)
+                        if sent == 0:
+                            break
+                        offset += sent
+                    src.seek(offset)
+                    return
+                except OSError:
+                    if offset != start:
+                        raise
+                    # sendfile can't write to this destination; copy through user space
+            shutil.copyfileobj(src, dst, STREAM_CHUNK_SIZE)
+
     def get(self, key):
         try:
             with open(self._path(key), 'rb') as f:
                 return f.read()
         except FileNotFoundError:
             raise KeyError(key)
+
+    def get_stream(self, key, chunk_size=STREAM_CHUNK_SIZE):
+        """ yield the data associated with the key in chunks, without reading it all into memory """
+        try:
+            f = open(self._path(key), 'rb')
+        except FileNotFoundError:
+            raise KeyError(key)
+        with f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def get_into(self, key, buf):
+        """ read the data associated with the key into the writable buffer buf,
+        returning its length. buf can be reused between calls. """
+        try:
+            f = open(self._path(key), 'rb', buffering=0)
+        except FileNotFoundError:
+            raise KeyError(key)
+        with f:
+            view = memoryview(buf)
+            if os.fstat(f.fileno()).st_size > len(view):
+                raise ValueError(f'buffer too small for {key}')
+            length = 0
+            while length < len(view):
+                n = f.readinto(view[length:])
+                if not n:
+                    break
+                length += n
+            return length
         
     def exists(self, key):
-        return os.path.exists(self._path(key))
+        try:
+            os.stat(self._path(key))
+            return True
+        except (FileNotFoundError, NotADirectoryError):
+            return False
     
     def delete(self, key):
         try:
@@ -34,34 +150,90 @@ class FilesystemStore(ObjectStore):
             raise KeyError(key)
 
     def keys(self):
-        for dirpath, dirnames, filenames in os.walk(self.root_path):
-            for filename in filenames:
-                yield os.path.relpath(os.path.join(dirpath, filename), self.root_path)
+        return walk_files(self.root_path)
+
 
+_sha256 = hashlib.sha256
 
+
+@functools.lru_cache(maxsize=8192)
 def hashpath(key, width=2, depth=3):
-    hash = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    hash = _sha256(key.encode('utf-8')).hexdigest()
+    sep = os.sep
+    if width == 2 and depth == 3:
+        # the default layout, built without intermediate lists
+        return f'{hash[0:2]}{sep}{hash[2:4]}{sep}{hash[4:6]}{sep}{hash[6:]}'
     # split hash into chunks of size 'width' up to the specified depth
     path_components = [hash[i:i+width] for i in range(0, width*depth, width)]
     # append the remaining part of the hash as a single component
     path_components.append(hash[width*depth:])
-    return os.path.join(*path_components)
+    return sep.join(path_components)
+
+
+def hashdir_depth(expected_keys, width=2, keys_per_dir=1000):
+    """ return the smallest depth at which expected_keys spread over
+    hashed directories of the given width leaves about keys_per_dir keys in each """
+    dirs_needed = expected_keys / keys_per_dir
+    if dirs_needed <= 1:
+        return 1
+    return max(1, math.ceil(math.log(dirs_needed, 16 ** width)))
+
+
+# a depth chosen from expected_keys is recorded in this file in the root directory
+DEPTH_FILE = '.hashdir-depth'
+
+DEFAULT_DEPTH = 3
+
+
+def hashdir_store_depth(root_path, width=2, depth=None, expected_keys=None):
+    """ return the directory depth for a hashdir store at root_path.
+
+    The depth decides where every object is stored, so once a depth has been chosen from
+    expected_keys it is recorded in the root directory and used whenever the store is opened
+    again. Otherwise depth is used, defaulting to DEFAULT_DEPTH.
+
+    A depth is only chosen from expected_keys for a new or empty root directory. Objects
+    already in a root without a recorded depth are assumed to be at DEFAULT_DEPTH, and
+    ValueError is raised if expected_keys calls for a different depth. """
+    if depth is not None and expected_keys is not None:
+        raise ValueError('give either depth or expected_keys, not both')
+    depth_path = os.path.join(root_path, DEPTH_FILE)
+    try:
+        with open(depth_path) as f:
+            recorded = int(f.read())
+    except FileNotFoundError:
+        recorded = None
+    if recorded is not None:
+        if depth is not None and depth != recorded:
+            raise ValueError(f'{root_path} was created with depth {recorded}, not {depth}')
+        return recorded
+    if expected_keys is None:
+        return DEFAULT_DEPTH if depth is None else depth
+    depth = hashdir_depth(expected_keys, width)
+    try:
+        populated = any(True for _ in os.scandir(root_path))
+    except FileNotFoundError:
+        populated = False
+    if populated:
+        if depth != DEFAULT_DEPTH:
+            raise ValueError(f'{root_path} already holds objects at depth {DEFAULT_DEPTH}, '
+                             f'not the depth {depth} chosen for {expected_keys} keys')
+        return depth
+    os.makedirs(root_path, exist_ok=True)
+    with open(depth_path, 'w') as f:
+        f.write(str(depth))
+    return depth
 
 
 class HashdirStore(FilesystemStore):
-    def __init__(self, root_path, width=2, depth=3):
-        self.root_path = root_path
+    def __init__(self, root_path, width=2, depth=None, expected_keys=None):
+        """ if expected_keys is given instead of depth, the depth is chosen to suit that many keys; see hashdir_store_depth """
+        super().__init__(root_path)
         self.width = width
-        self.depth = depth
+        self.depth = hashdir_store_depth(root_path, width, depth, expected_keys)
 
     def _path(self, key):
-        return os.path.join(self.root_path, hashpath(key, self.width, self.depth))
-    
-    def put(self, key, data):
-        path = self._path(key)
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'wb') as f:
-            f.write(data)
+        return self._root_prefix + hashpath(key, self.width, self.depth)
 
     def keys(self):
         raise NotImplementedError
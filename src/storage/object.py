@@ -7,6 +7,9 @@ The ObjectStore class is an abstract base class that defines the interface for a
 The DictStore class is a simple implementation of an object store that stores objects in a dictionary in memory.
 """
 
+# size of the chunks read and written by the streaming methods of the stores
+STREAM_CHUNK_SIZE = 1024 * 1024
+
 class ObjectStore(ABC):
     """
     An abstract base class for an object store.
@@ -21,16 +24,25 @@ class ObjectStore(ABC):
     
     Stateful implementations of the object store should provide a context manager interface, allowing the store to be used in a with statement.
     """
+    __slots__ = () # lets subclasses that declare __slots__ do without an instance __dict__
+
     @abstractmethod
-    def get(self, key) -> bytearray:
-        """ return the data associated with the key"""
+    def get(self, key) -> bytes:
+        """ return the data associated with the key.
+        implementations may return any bytes-like object rather than copying it into bytes. """
         pass
 
     @abstractmethod
-    def put(self, key, data: bytearray):
+    def put(self, key, data: bytes):
         """ store the data associated with the key from the file-like object data. """
         pass
 
+    def put_many(self, items):
+        """ store each (key, data) pair in items. implementations may override this
+        to write the batch more efficiently than individual puts. """
+        for key, data in items:
+            self.put(key, data)
+
     @abstractmethod
     def exists(self, key):
         """ return True if the key exists in the store, False otherwise. """
@@ -51,6 +63,8 @@ class DictStore(ObjectStore):
     """
     Stores data in a dictionary in memory.
     """
+    __slots__ = ('objects',)
+
     def __init__(self):
         self.objects = {}
 
@@ -61,10 +75,7 @@ class DictStore(ObjectStore):
         pass
 
     def get(self, key):
-        bytes = self.objects.get(key)
-        if bytes is None:
-            raise KeyError(key)
-        return bytes
+        return self.objects[key]
 
     def put(self, key, data):
         self.objects[key] = data
@@ -73,8 +84,6 @@ class DictStore(ObjectStore):
         return key in self.objects
 
     def delete(self, key):
-        if not self.exists(key):
-            raise KeyError(key)
         del self.objects[key]
 
     def keys(self):
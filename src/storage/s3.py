@@ -1,140 +1,581 @@
+import io
+import time
+import asyncio
+import functools
+import itertools
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
 import botocore
 import aiobotocore
 from aiobotocore.session import get_session
+from aiobotocore.config import AioConfig
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.exceptions import ClientError
 
 from .object import ObjectStore
 
+# size of the reads used to fill a response buffer
+BODY_CHUNK_SIZE = 1024 * 1024
+
+# objects larger than this are transferred in parts of this size, in parallel
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+MULTIPART_CONCURRENCY = 10
+
+# the most keys S3 accepts in one delete_objects request
+DELETE_BATCH_SIZE = 1000
+
+# the most head_object results or presigned URLs kept by each store when
+# caching is enabled; the least recently used are dropped first
+CACHE_SIZE = 10000
+
+# botocore client settings used unless overridden. the default pool of 10 connections
+# is smaller than the number of requests the stores make in parallel, and
+# connections that don't fit in the pool are discarded rather than reused.
+# the standard retry mode backs off with jitter and stops retrying when most
+# requests are failing, where the default legacy mode can make throttling worse
+BOTOCORE_CONFIG_DEFAULTS = {
+    'max_pool_connections': 50,
+    'retries': {'mode': 'standard', 'max_attempts': 10},
+}
+
+# error codes S3 returns for a missing object (HEAD responses have no body, so only the status)
+_NOT_FOUND_CODES = ('404', 'NoSuchKey', 'NotFound')
+
+
+# boto3 sessions are slow to create and load their botocore data on first use,
+# so one is shared by the stores for each endpoint and access key. sessions
+# are not thread-safe, so clients are created from them under a lock
+_session_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def _session(s3_url, s3_access_key):
+    return boto3.session.Session()
+
+
+def client_config(**kwargs):
+    """ return an AioConfig for an aiobotocore S3 client to be used with AsyncBucketStore,
+    with BOTOCORE_CONFIG_DEFAULTS applied unless overridden by kwargs """
+    return AioConfig(**{**BOTOCORE_CONFIG_DEFAULTS, **kwargs})
+
+
+class _TTLCache:
+    """ an LRU cache whose entries expire after a time to live given when they're set.
+    it is locked because BucketStore's put_many and get_many use it from several threads """
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ return (True, value) if a live entry is cached for key, otherwise (False, None) """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[0] <= time.monotonic():
+                del self.entries[key]
+                return False, None
+            self.entries.move_to_end(key)
+            return True, entry[1]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+def _delete_request(keys):
+    return {'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+
+
+def _delete_errors(response):
+    """ return a dict mapping each key that could not be deleted to its error message """
+    return {error['Key']: f"{error['Code']}: {error['Message']}" for error in response.get('Errors', [])}
+
+
+def _range_total(response):
+    """ return the total object size from the ContentRange of a ranged get,
+    or None if the whole object was returned """
+    content_range = response.get('ContentRange')
+    if not content_range:
+        return None
+    return int(content_range.rsplit('/', 1)[1])
+
+
+def _part_ranges(start, size, chunk_size):
+    """ return inclusive (first, last) byte ranges covering start to size """
+    return [(offset, min(offset + chunk_size, size) - 1) for offset in range(start, size, chunk_size)]
+
+
+async def _read_into(body, view, chunk_size=BODY_CHUNK_SIZE):
+    """ fill the memoryview view from an aiobotocore response body """
+    length = len(view)
+    offset = 0
+    while offset < length:
+        chunk = await body.read(min(chunk_size, length - offset))
+        if not chunk:
+            raise EOFError(f'response body ended after {offset} of {length} bytes')
+        view[offset:offset+len(chunk)] = chunk
+        offset += len(chunk)
+
+
+async def _read_body(response, chunk_size=BODY_CHUNK_SIZE):
+    """ read an aiobotocore response body into a buffer preallocated from its
+    ContentLength, rather than collecting the chunks and joining them """
+    body = response['Body']
+    length = response.get('ContentLength')
+    if length is None:
+        return bytearray(await body.read())
+    buf = bytearray(length)
+    await _read_into(body, memoryview(buf), chunk_size)
+    return buf
+
 
 class BucketStore(ObjectStore):
-    def __init__(self, s3_url, s3_access_key, s3_secret_key, bucket_name, botocore_config_kwargs={}):
+    def __init__(self, s3_url, s3_access_key, s3_secret_key, bucket_name, botocore_config_kwargs={},
+                 multipart_chunksize=MULTIPART_CHUNK_SIZE, max_concurrency=MULTIPART_CONCURRENCY, s3_client=None,
+                 head_cache_ttl=0, cache_presigned=False):
+        """
+        Objects larger than multipart_chunksize are transferred in parts of that size, up to max_concurrency at once.
+        head_cache_ttl (in seconds) and cache_presigned turn on reuse of head_object results and presigned URLs.
+        get returns bytes, or a bytearray for objects larger than multipart_chunksize.
+        A given s3_client is used instead of creating one, and is not closed by close().
+        """
         self.s3_url = s3_url
         self.s3_access_key = s3_access_key
         self.s3_secret_key = s3_secret_key
         self.bucket_name = bucket_name
         self.session = None
-        self.s3_client = None
+        self.s3_client = s3_client
+        self.owns_client = s3_client is None
+        self.transfer_manager = None
+        self._transfer_manager_lock = threading.Lock()
         self.botocore_config_kwargs = botocore_config_kwargs
+        self.multipart_chunksize = multipart_chunksize
+        self.max_concurrency = max_concurrency
+        self.head_cache_ttl = head_cache_ttl
+        self.cache_presigned = cache_presigned
+        self._head_cache = _TTLCache()
+        self._presigned_cache = _TTLCache()
+
+    def open(self):
+        if self.owns_client:
+            config = botocore.config.Config(**{**BOTOCORE_CONFIG_DEFAULTS, **self.botocore_config_kwargs})
+            self.session = _session(self.s3_url, self.s3_access_key)
+            with _session_lock:
+                self.s3_client = self.session.client(
+                    's3',
+                    endpoint_url=self.s3_url,
+                    aws_access_key_id=self.s3_access_key,
+                    aws_secret_access_key=self.s3_secret_key,
+                    config = config
+                )
+
+    def _get_transfer_manager(self):
+        """ the transfer manager for file-like and multipart puts, created on first use
+        so that a store given an s3_client works without open() """
+        with self._transfer_manager_lock:
+            if self.transfer_manager is None:
+                self.transfer_manager = create_transfer_manager(self.s3_client, TransferConfig(
+                    multipart_threshold=self.multipart_chunksize,
+                    multipart_chunksize=self.multipart_chunksize,
+                    max_concurrency=self.max_concurrency,
+                ))
+            return self.transfer_manager
+
+    def close(self):
+        if self.transfer_manager is not None:
+            self.transfer_manager.shutdown()
+            self.transfer_manager = None
+        if self.owns_client:
+            self.s3_client.close()
+            self.s3_client = None
 
     def __enter__(self):
-        self.session = boto3.session.Session()
-        config = botocore.config.Config(**self.botocore_config_kwargs) if self.botocore_config_kwargs else None
-        self.s3_client = self.session.client(
-            's3',
-            endpoint_url=self.s3_url,
-            aws_access_key_id=self.s3_access_key,
-            aws_secret_access_key=self.s3_secret_key,
-            config = config
-        )
+        self.open()
         return self
     
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.s3_client.close()
+        self.close()
 
     def put(self, key, data):
+        """ store data, which may be bytes-like or a binary file-like object """
+        self._head_cache.discard(key)
+        if hasattr(data, 'read'):
+            # the transfer manager reads file objects in parts, uploading them in parallel if large
+            self._get_transfer_manager().upload(data, self.bucket_name, key).result()
+            return True
+        if len(data) > self.multipart_chunksize:
+            self._get_transfer_manager().upload(io.BytesIO(data), self.bucket_name, key).result()
+            return True
         self.s3_client.put_object(
             Bucket=self.bucket_name,
             Key=key,
             Body=data
         )
         return True
+
+    def put_many(self, items, concurrency=16):
+        # botocore clients are thread-safe, so the puts can share one
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(self.put, key, data) for key, data in items]
+        for future in futures:
+            future.result()
     
     def get(self, key):
-        response = self.s3_client.get_object(
-            Bucket=self.bucket_name,
-            Key=key
-        )
-        file_contents = response['Body'].read()
-        return file_contents
+        # fetch the first part, which is the whole object unless it's large
+        try:
+            response = self.s3_client.get_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                Range=f'bytes=0-{self.multipart_chunksize - 1}'
+            )
+        except self.s3_client.exceptions.NoSuchKey:
+            raise KeyError(key)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidRange':
+                raise
+            return b'' # empty objects have no satisfiable range
+        first_part = response['Body'].read()
+        size = _range_total(response)
+        if size is None or size <= len(first_part):
+            return first_part
+        # fetch the rest of the object in parallel into one buffer
+        buf = bytearray(size)
+        view = memoryview(buf)
+        view[:len(first_part)] = first_part
+        etag = response['ETag']
+
+        def get_part(first, last):
+            part = self.s3_client.get_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                Range=f'bytes={first}-{last}',
+                IfMatch=etag # fail rather than mix versions if the object changes
+            )
+            view[first:last+1] = part['Body'].read()
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = [executor.submit(get_part, first, last)
+                       for first, last in _part_ranges(len(first_part), size, self.multipart_chunksize)]
+        for future in futures:
+            future.result()
+        return buf
+
+    def get_many(self, keys, concurrency=16):
+        """ fetch keys concurrently, with at most concurrency requests in flight.
+        returns a dict mapping each key to its data, or to the exception raised
+        while fetching it (KeyError if it does not exist). """
+        keys = list(keys)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(self.get, key) for key in keys]
+        return {key: future.exception() or future.result() for key, future in zip(keys, futures)}
     
-    def exists(self, key):
+    def _head(self, key):
+        """ return the head_object response for key, or None if it does not exist """
+        hit, response = self._head_cache.get(key)
+        if hit:
+            return response
         try:
-            self.s3_client.head_object(
+            response = self.s3_client.head_object(
                 Bucket=self.bucket_name,
                 Key=key
             )
-            return True
-        except self.s3_client.exceptions.NoSuchKey:
-            return False
+        except ClientError as e:
+            if e.response['Error']['Code'] not in _NOT_FOUND_CODES:
+                raise
+            response = None
+        if self.head_cache_ttl:
+            self._head_cache.set(key, response, self.head_cache_ttl)
+        return response
+
+    def head(self, key):
+        """ return the head_object response for key (ContentLength, ETag, etc) """
+        response = self._head(key)
+        if response is None:
+            raise KeyError(key)
+        return response
+
+    def exists(self, key):
+        return self._head(key) is not None
         
     def delete(self, key):
+        self._head_cache.discard(key)
         self.s3_client.delete_object(
             Bucket=self.bucket_name,
             Key=key
         )
         return True
+
+    def delete_many(self, keys):
+        """ delete the keys with delete_objects requests of up to DELETE_BATCH_SIZE keys.
+        keys that don't exist are ignored. returns a dict mapping each key that
+        could not be deleted to the error S3 reported for it. """
+        errors = {}
+        keys = iter(keys)
+        while True:
+            batch = list(itertools.islice(keys, DELETE_BATCH_SIZE))
+            if not batch:
+                break
+            for key in batch:
+                self._head_cache.discard(key)
+            response = self.s3_client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete=_delete_request(batch)
+            )
+            errors.update(_delete_errors(response))
+        return errors
     
     def keys(self, prefix=''):
-        response = self.s3_client.list_objects_v2(
-            Bucket=self.bucket_name,
-            Prefix=prefix
-        )
-        keys = [obj['Key'] for obj in response['Contents']]
-        return keys
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
 
-    def presigned_put(self, key, expiry=3600):
-        return self.s3_client.generate_presigned_url('put_object',
+    def _presigned(self, method, key, expiry):
+        hit, url = self._presigned_cache.get((method, key, expiry))
+        if hit:
+            return url
+        url = self.s3_client.generate_presigned_url(method,
             Params={'Key':key, 'Bucket':self.bucket_name}, ExpiresIn=expiry
         )
+        if self.cache_presigned:
+            self._presigned_cache.set((method, key, expiry), url, expiry / 2)
+        return url
+
+    def presigned_put(self, key, expiry=3600):
+        return self._presigned('put_object', key, expiry)
 
     def presigned_get(self, key, expiry=3600):
-        return self.s3_client.generate_presigned_url('get_object',
-            Params={'Key':key, 'Bucket':self.bucket_name}, ExpiresIn=expiry
-        )
+        return self._presigned('get_object', key, expiry)
 
 class AsyncBucketStore(ObjectStore):
-    def __init__(self, s3_client, bucket_name):
+    def __init__(self, s3_client, bucket_name, multipart_chunksize=MULTIPART_CHUNK_SIZE, max_concurrency=MULTIPART_CONCURRENCY,
+                 head_cache_ttl=0, cache_presigned=False):
+        """ the options are as for BucketStore. get returns a bytearray """
         self.bucket_name = bucket_name
         self.s3_client = s3_client
+        self.multipart_chunksize = multipart_chunksize
+        self.max_concurrency = max_concurrency
+        self.head_cache_ttl = head_cache_ttl
+        self.cache_presigned = cache_presigned
+        self._head_cache = _TTLCache()
+        self._presigned_cache = _TTLCache()
+
+    async def _put_multipart(self, key, data):
+        upload = await self.s3_client.create_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=key
+        )
+        upload_id = upload['UploadId']
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        view = memoryview(data)
+
+        async def upload_part(part_number, offset):
+            async with semaphore:
+                # botocore only accepts bytes-like bodies of certain types, so each
+                # part is copied as it is sent; at most max_concurrency copies at once
+                response = await self.s3_client.upload_part(
+                    Bucket=self.bucket_name,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    Body=bytes(view[offset:offset+self.multipart_chunksize])
+                )
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+        tasks = [asyncio.ensure_future(upload_part(part_number, offset)) for part_number, offset
+                 in enumerate(range(0, len(view), self.multipart_chunksize), 1)]
+        try:
+            parts = await asyncio.gather(*tasks)
+            await self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except BaseException:
+            # don't leave the uploaded parts behind, taking up (billed) space,
+            # and don't start uploading parts of an aborted upload
+            for task in tasks:
+                task.cancel()
+            await self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=key,
+                UploadId=upload_id
+            )
+            raise
 
     async def put(self, key, data):
+        """ store data, which may be bytes-like or a binary file-like object """
+        self._head_cache.discard(key)
+        # file-like objects are passed to put_object as they are
+        if not hasattr(data, 'read') and len(data) > self.multipart_chunksize:
+            await self._put_multipart(key, data)
+            return True
         await self.s3_client.put_object(
             Bucket=self.bucket_name,
             Key=key,
             Body=data
         )
         return True
+
+    async def put_many(self, items, concurrency=32):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def put(key, data):
+            async with semaphore:
+                await self.put(key, data)
+
+        await asyncio.gather(*(put(key, data) for key, data in items))
     
     async def get(self, key):
-        response = await self.s3_client.get_object(
-            Bucket=self.bucket_name,
-            Key=key
-        )
-        file_contents = await response['Body'].read()
-        return file_contents
+        # fetch the first part, which is the whole object unless it's large
+        try:
+            response = await self.s3_client.get_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                Range=f'bytes=0-{self.multipart_chunksize - 1}'
+            )
+        except self.s3_client.exceptions.NoSuchKey:
+            raise KeyError(key)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidRange':
+                raise
+            return bytearray() # empty objects have no satisfiable range
+        size = _range_total(response)
+        if size is None or size <= response['ContentLength']:
+            return await _read_body(response)
+        # read the first part and fetch the rest of the object in parallel into one buffer
+        buf = bytearray(size)
+        view = memoryview(buf)
+        etag = response['ETag']
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def get_part(first, last):
+            async with semaphore:
+                part = await self.s3_client.get_object(
+                    Bucket=self.bucket_name,
+                    Key=key,
+                    Range=f'bytes={first}-{last}',
+                    IfMatch=etag # fail rather than mix versions if the object changes
+                )
+                async with part['Body'] as body: # releases the connection if reading fails
+                    await _read_into(body, view[first:last+1])
+
+        async def get_first_part():
+            async with semaphore:
+                await _read_into(response['Body'], view[:response['ContentLength']])
+
+        tasks = [asyncio.ensure_future(get_first_part())]
+        tasks.extend(asyncio.ensure_future(get_part(first, last)) for first, last
+                     in _part_ranges(response['ContentLength'], size, self.multipart_chunksize))
+        async with response['Body']:
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # don't keep fetching the other parts of a failed get
+                for task in tasks:
+                    task.cancel()
+                raise
+        return buf
+
+    async def get_many(self, keys, concurrency=32):
+        """ fetch keys concurrently, with at most concurrency requests in flight.
+        returns a dict mapping each key to its data, or to the exception raised
+        while fetching it (KeyError if it does not exist). """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def get(key):
+            async with semaphore:
+                return await self.get(key)
+
+        keys = list(keys)
+        results = await asyncio.gather(*(get(key) for key in keys), return_exceptions=True)
+        return dict(zip(keys, results))
     
-    async def exists(self, key):
+    async def _head(self, key):
+        """ return the head_object response for key, or None if it does not exist """
+        hit, response = self._head_cache.get(key)
+        if hit:
+            return response
         try:
-            await self.s3_client.head_object(
+            response = await self.s3_client.head_object(
                 Bucket=self.bucket_name,
                 Key=key
             )
-            return True
-        except self.s3_client.exceptions.NoSuchKey:
-            return False
+        except ClientError as e:
+            if e.response['Error']['Code'] not in _NOT_FOUND_CODES:
+                raise
+            response = None
+        if self.head_cache_ttl:
+            self._head_cache.set(key, response, self.head_cache_ttl)
+        return response
+
+    async def head(self, key):
+        """ return the head_object response for key (ContentLength, ETag, etc) """
+        response = await self._head(key)
+        if response is None:
+            raise KeyError(key)
+        return response
+
+    async def exists(self, key):
+        return await self._head(key) is not None
         
     async def delete(self, key):
+        self._head_cache.discard(key)
         response = await self.s3_client.delete_object(
             Bucket=self.bucket_name,
             Key=key
         )
         return True
+
+    async def delete_many(self, keys):
+        """ delete the keys with delete_objects requests of up to DELETE_BATCH_SIZE keys.
+        keys that don't exist are ignored. returns a dict mapping each key that
+        could not be deleted to the error S3 reported for it. """
+        errors = {}
+        keys = list(keys)
+        for key in keys:
+            self._head_cache.discard(key)
+        for i in range(0, len(keys), DELETE_BATCH_SIZE):
+            response = await self.s3_client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete=_delete_request(keys[i:i+DELETE_BATCH_SIZE])
+            )
+            errors.update(_delete_errors(response))
+        return errors
     
     async def keys(self, prefix=''):
-        # FIXME paginate
-        response = await self.s3_client.list_objects_v2(
-            Bucket=self.bucket_name,
-            Prefix=prefix
-        )
-        keys = [obj['Key'] for obj in response['Contents']]
-        return keys
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        async for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
 
-    async def presigned_put(self, key, expiry=3600):
-        return await self.s3_client.generate_presigned_url('put_object',
+    async def _presigned(self, method, key, expiry):
+        hit, url = self._presigned_cache.get((method, key, expiry))
+        if hit:
+            return url
+        url = await self.s3_client.generate_presigned_url(method,
             Params={'Key':key, 'Bucket':self.bucket_name}, ExpiresIn=expiry
         )
+        if self.cache_presigned:
+            self._presigned_cache.set((method, key, expiry), url, expiry / 2)
+        return url
+
+    async def presigned_put(self, key, expiry=3600):
+        return await self._presigned('put_object', key, expiry)
 
     async def presigned_get(self, key, expiry=3600):
-        return await self.s3_client.generate_presigned_url('get_object',
-            Params={'Key':key, 'Bucket':self.bucket_name}, ExpiresIn=expiry
-        )
+        return await self._presigned('get_object', key, expiry)
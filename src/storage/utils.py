@@ -1,31 +1,67 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
 from storage.object import ObjectStore
 
 # Store implemtations that combine multiple stores in some way
 
 class FanoutStore(ObjectStore):
-    def __init__(self, children):
+    def __init__(self, children, concurrent=False):
+        """
+        If concurrent is True, put, put_many, exists and delete run on all the children
+        at once in a thread pool, so they take as long as the slowest child rather than
+        the sum of all of them. The children must then be usable from other threads
+        (BucketStore and FilesystemStore are, SqliteStore is not).
+        """
         self.children = children
+        self.executor = ThreadPoolExecutor(max_workers=len(children)) if concurrent and len(children) > 1 else None
+
+    def close(self):
+        """ shut down the thread pool, if any. the children are left open """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _map(self, fn):
+        """ call fn on each child, returning the results in order """
+        if self.executor is None:
+            return [fn(child) for child in self.children]
+        return list(self.executor.map(fn, self.children))
 
     def put(self, key, data):
-        for child in self.children:
-            child.put(key, data)
+        self._map(lambda child: child.put(key, data))
+
+    def put_many(self, items):
+        items = list(items)
+        self._map(lambda child: child.put_many(items))
 
     def get(self, key):
         for child in self.children:
-            if child.exists(key):
+            try:
                 return child.get(key)
+            except KeyError:
+                continue
         raise KeyError(key)
 
     def exists(self, key):
-        for child in self.children:
-            if child.exists(key):
-                return True
-        return False
+        if self.executor is None:
+            return any(child.exists(key) for child in self.children)
+        futures = [self.executor.submit(child.exists, key) for child in self.children]
+        return any(future.result() for future in as_completed(futures))
+
+    def _delete(self, child, key):
+        try:
+            child.delete(key)
+        except KeyError:
+            pass
 
     def delete(self, key):
-        for child in self.children:
-            if child.exists(key):
-                child.delete(key)
+        self._map(lambda child: self._delete(child, key))
 
     def keys(self):
         keys = set()
@@ -44,20 +80,23 @@ class CachingStore(ObjectStore):
         self.cache_store.put(key, data)
 
     def get(self, key):
-        if self.cache_store.exists(key):
+        try:
             return self.cache_store.get(key)
-        else:
-            data = self.main_store.get(key)
-            self.cache_store.put(key, data)
-            return data
+        except KeyError:
+            pass
+        data = self.main_store.get(key)
+        self.cache_store.put(key, data)
+        return data
 
     def exists(self, key):
         return self.cache_store.exists(key) or self.main_store.exists(key)
 
     def delete(self, key):
         self.main_store.delete(key)
-        if self.cache_store.exists(key):
+        try:
             self.cache_store.delete(key)
+        except KeyError:
+            pass
 
     def keys(self):
         return self.main_store.keys()
@@ -66,28 +105,67 @@ class CachingStore(ObjectStore):
         if key is None:
             for cached_key in self.cache_store.keys():
                 self.cache_store.delete(cached_key)
-        elif self.cache_store.exists(key):
-            self.cache_store.delete(key)
+        else:
+            try:
+                self.cache_store.delete(key)
+            except KeyError:
+                pass
 
    
 # utility functions for multi-store actions
+
+def _for_each_key(keys, fn, concurrency):
+    """ call fn(key) for each key. if concurrency is more than 1, that many calls
+    run at once in a thread pool, so the stores must be usable from other threads """
+    if concurrency <= 1:
+        for key in keys:
+            fn(key)
+        return
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = set()
+        for key in keys:
+            # bound the keys in flight rather than submitting them all up front
+            if len(pending) >= concurrency * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(executor.submit(fn, key))
+        for future in as_completed(pending):
+            future.result()
+
             
-def copy_store(from_store, to_store, overwrite=True):
-    for key in from_store.keys():
+def copy_store(from_store, to_store, overwrite=True, concurrency=1):
+    def copy(key):
         if overwrite or not to_store.exists(key):
             to_store.put(key, from_store.get(key))
 
+    _for_each_key(from_store.keys(), copy, concurrency)
+
 
 def clear_store(store):
+    if hasattr(store, 'delete_many'):
+        # the store can delete many keys per request
+        errors = store.delete_many(store.keys())
+        if errors:
+            raise RuntimeError(f'failed to delete {len(errors)} keys, e.g. {next(iter(errors.items()))}')
+        return
     for key in store.keys():
         store.delete(key)
 
 
-def sync_stores(from_store, to_store, delete=False):
-    from_keys = set(from_store.keys())
+def sync_stores(from_store, to_store, delete=False, concurrency=1):
+    # one listing of to_store is much cheaper than an exists() per key.
+    # from_store's keys are only collected when they're needed for deleting
     to_keys = set(to_store.keys())
-    for key in from_keys - to_keys:
-        to_store.put(key, from_store.get(key))
+    from_keys = set()
+
+    def missing_keys():
+        for key in from_store.keys():
+            if delete:
+                from_keys.add(key)
+            if key not in to_keys:
+                yield key
+
+    _for_each_key(missing_keys(), lambda key: to_store.put(key, from_store.get(key)), concurrency)
     if delete:
-        for key in to_keys - from_keys:
-            to_store.delete(key)
\ No newline at end of file
+        _for_each_key(to_keys - from_keys, to_store.delete, concurrency)
\ No newline at end of file
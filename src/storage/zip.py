@@ -1,6 +1,10 @@
-from zipfile import ZipFile
+import time
+import shutil
+
+from zipfile import ZipFile, ZipInfo
+
+from storage.object import ObjectStore, STREAM_CHUNK_SIZE
 
-from storage.object import ObjectStore
 
 class ZipStore(ObjectStore):
     """
@@ -15,24 +19,76 @@ class ZipStore(ObjectStore):
 
     def __enter__(self):
         self.zipfile = ZipFile(self.path, 'a')
+        # the names in the archive, kept up to date by put
+        self._names = set(self.zipfile.NameToInfo)
         return self
     
     def __exit__(self, exc_type, exc_value, traceback):
         self.zipfile.close()
 
-    def put(self, key, data: bytearray):
+    def put(self, key, data: bytes):
         if self.exists(key):
             raise KeyError(f'zipfile entry for {key} already exists')
+        # writestr writes data straight into the entry, without copying it
         self.zipfile.writestr(key, data)
+        self._names.add(key)
+
+    def put_many(self, items):
+        """ store each (key, data) pair in items. if any key already exists,
+        KeyError is raised before anything is written """
+        items = list(items)
+        names = self._names
+        batch_names = set()
+        for key, _ in items:
+            if key in names or key in batch_names:
+                raise KeyError(f'zipfile entry for {key} already exists')
+            batch_names.add(key)
+        writestr = self.zipfile.writestr
+        for key, data in items:
+            writestr(key, data)
+            names.add(key)
 
-    def get(self, key) -> bytearray:
+    def _open_for_write(self, key):
+        if self.exists(key):
+            raise KeyError(f'zipfile entry for {key} already exists')
+        # the same entry attributes writestr uses
+        zinfo = ZipInfo(key, date_time=time.localtime()[:6])
+        zinfo.compress_type = self.zipfile.compression
+        zinfo.external_attr = 0o600 << 16
+        # the size isn't known in advance, so allow for entries over 2 GiB
+        dst = self.zipfile.open(zinfo, 'w', force_zip64=True)
+        self._names.add(key)
+        return dst
+
+    def put_stream(self, key, chunks):
+        """ store the data from the iterable chunks without assembling it in memory """
+        with self._open_for_write(key) as dst:
+            for chunk in chunks:
+                dst.write(chunk)
+
+    def put_file(self, key, src):
+        """ store the remaining contents of the binary file object src without reading it all into memory """
+        with self._open_for_write(key) as dst:
+            shutil.copyfileobj(src, dst, STREAM_CHUNK_SIZE)
+
+    def get(self, key) -> bytes:
         return self.zipfile.read(key)
+
+    def get_many(self, keys):
+        """ return a dict of the data for each of keys that exists in the store.
+        the entries are read in the order they appear in the archive """
+        name_to_info = self.zipfile.NameToInfo
+        infos = [name_to_info[key] for key in set(keys) if key in name_to_info]
+        infos.sort(key=lambda info: info.header_offset)
+        read = self.zipfile.read
+        return {info.filename: read(info) for info in infos}
     
     def exists(self, key):
-        return key in self.zipfile.namelist()
+        return key in self._names
     
     def delete(self, key):
         raise NotImplementedError('deleting from zip files is not supported')
     
     def keys(self):
-        return self.zipfile.namelist()
+        # listed from the archive's index by name, which keeps the entries in archive order
+        return list(self.zipfile.NameToInfo)
@@ -0,0 +1,115 @@
+import os
+import sys
+import asyncio
+import tempfile
+import unittest
+
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from storage import aiofs
+from storage.aiofs import AsyncFilesystemStore, AsyncHashdirStore, AsyncBufferedWriteStore
+from storage.aiodb import AsyncSqliteStore
+from storage.fs import hashdir_depth
+
+
+class TempDirTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def files(self):
+        return sorted(name for _, _, names in os.walk(self.root) for name in names)
+
+
+class TestAsyncFilesystemStore(TempDirTestCase):
+    async def test_batch_commits_concurrent_puts_together(self):
+        store = AsyncFilesystemStore(self.root, durability='batch', batch_delay=0.05)
+        with mock.patch.object(aiofs, '_commit_files', wraps=aiofs._commit_files) as commit_files:
+            await asyncio.gather(*(store.put(f'dir/key{i}', b'data%d' % i) for i in range(5)))
+        self.assertEqual(commit_files.call_count, 1)
+        for i in range(5):
+            self.assertEqual(await store.get(f'dir/key{i}'), b'data%d' % i)
+        self.assertEqual(self.files(), [f'key{i}' for i in range(5)])
+
+    async def test_batch_failure_removes_tmp_files(self):
+        store = AsyncFilesystemStore(self.root, durability='batch')
+        with mock.patch.object(aiofs, '_fdatasync', side_effect=OSError('sync failed')):
+            with self.assertRaises(OSError):
+                await asyncio.gather(store.put('a', b'a'), store.put('b', b'b'))
+        self.assertEqual(self.files(), [])
+
+    async def test_durability_modes(self):
+        for durability in ('none', 'sync', 'batch'):
+            store = AsyncFilesystemStore(os.path.join(self.root, durability), durability=durability)
+            await store.put('nested/key', b'data')
+            self.assertEqual(await store.get('nested/key'), b'data')
+            self.assertEqual([key async for key in store.keys()], ['nested/key'])
+
+    async def test_unknown_durability(self):
+        with self.assertRaises(ValueError):
+            AsyncFilesystemStore(self.root, durability='always')
+
+    async def test_hashdir_depth_from_expected_keys(self):
+        store = AsyncHashdirStore(self.root, expected_keys=100)
+        self.assertEqual(store.depth, hashdir_depth(100))
+        await store.put('key', b'data')
+        self.assertEqual(await AsyncHashdirStore(self.root).get('key'), b'data')
+
+
+class TestAsyncBufferedWriteStore(TempDirTestCase):
+    async def asyncSetUp(self):
+        self.index_store = AsyncSqliteStore(os.path.join(self.root, 'index.db'))
+        await self.index_store.open()
+
+    async def asyncTearDown(self):
+        await self.index_store.close()
+
+    def store(self, **kwargs):
+        return AsyncBufferedWriteStore(os.path.join(self.root, 'segments'), self.index_store,
+                                       flush_interval=60, **kwargs)
+
+    async def test_get_before_and_after_flush(self):
+        async with self.store() as store:
+            await store.put('a', b'first')
+            await store.put('b', b'second')
+            self.assertEqual(await store.get('a'), b'first')
+            await store.flush()
+            await store.put('c', b'third')
+            self.assertEqual(await store.get('b'), b'second')
+            self.assertEqual(await store.get('c'), b'third')
+            with self.assertRaises(KeyError):
+                await store.get('missing')
+
+    async def test_reopen_loads_index(self):
+        async with self.store() as store:
+            await store.put('a', b'first')
+            await store.put('a', b'overwritten')
+            await store.put('b', b'deleted')
+            await store.delete('b')
+        async with self.store() as store:
+            self.assertEqual(await store.get('a'), b'overwritten')
+            self.assertFalse(await store.exists('b'))
+            self.assertEqual([key async for key in store.keys()], ['a'])
+
+    async def test_segment_rotation(self):
+        async with self.store(flush_bytes=100, segment_size=100) as store:
+            data = {f'key{i}': os.urandom(37) for i in range(20)}
+            for key, value in data.items():
+                await store.put(key, value)
+            for key, value in data.items():
+                self.assertEqual(await store.get(key), value)
+        segments = os.path.join(self.root, 'segments')
+        sizes = [os.path.getsize(os.path.join(segments, name)) for name in os.listdir(segments)]
+        self.assertGreater(len(sizes), 1)
+        # a segment only grows past segment_size by less than its last object
+        self.assertLess(max(sizes), 100 + 37)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import sys
+import asyncio
+import tempfile
+import unittest
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from storage.aiofs import AsyncFilesystemStore
+from storage.aioutils import AsyncCachingStore
+
+
+class CountingStore(AsyncFilesystemStore):
+    """ counts the exists calls that reach it, and can fail to list its keys """
+    def __init__(self, root_path):
+        super().__init__(root_path)
+        self.exists_calls = 0
+        self.keys_error = None
+
+    async def exists(self, key):
+        self.exists_calls += 1
+        return await super().exists(key)
+
+    async def keys(self):
+        if self.keys_error is not None:
+            raise self.keys_error
+        async for key in super().keys():
+            yield key
+
+
+class TestAsyncCachingStoreIndex(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.main_tmp = tempfile.TemporaryDirectory()
+        self.cache_tmp = tempfile.TemporaryDirectory()
+        self.main = CountingStore(self.main_tmp.name)
+        self.store = AsyncCachingStore(self.main, AsyncFilesystemStore(self.cache_tmp.name), index_keys=True)
+
+    def tearDown(self):
+        self.main_tmp.cleanup()
+        self.cache_tmp.cleanup()
+
+    async def build_index(self):
+        await self.store.exists('anything')
+        await self.store._index_task
+
+    async def test_absent_keys_skip_main_store(self):
+        await self.main.put('listed', b'data')
+        await self.build_index()
+        self.main.exists_calls = 0
+        self.assertFalse(await self.store.exists('absent'))
+        self.assertEqual(self.main.exists_calls, 0)
+        await self.store.clear()
+        self.assertTrue(await self.store.exists('listed'))
+        await self.store.put('new', b'data')
+        await self.store.clear()
+        self.assertTrue(await self.store.exists('new'))
+
+    async def test_delete_keeps_key_hash(self):
+        await self.store.put('key', b'data')
+        await self.build_index()
+        await self.store.delete('key')
+        self.main.exists_calls = 0
+        # the key's hash may be shared with another key, so main_store is asked
+        self.assertFalse(await self.store.exists('key'))
+        self.assertEqual(self.main.exists_calls, 1)
+
+    async def test_index_failure_is_raised_then_retried(self):
+        self.main.keys_error = OSError('listing failed')
+        await self.store.exists('anything')
+        await asyncio.wait([self.store._index_task])
+        with self.assertRaises(OSError):
+            await self.store.exists('key')
+        self.main.keys_error = None
+        await self.build_index()
+        self.main.exists_calls = 0
+        self.assertFalse(await self.store.exists('absent'))
+        self.assertEqual(self.main.exists_calls, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import sys
+import tempfile
+import unittest
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from storage.fs import HashdirStore, hashdir_depth, DEPTH_FILE, DEFAULT_DEPTH
+
+
+class TestHashdirDepth(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, 'store')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_default_depth(self):
+        store = HashdirStore(self.root)
+        self.assertEqual(store.depth, DEFAULT_DEPTH)
+        self.assertFalse(os.path.exists(os.path.join(self.root, DEPTH_FILE)))
+
+    def test_expected_keys_depth_is_recorded(self):
+        store = HashdirStore(self.root, expected_keys=100)
+        self.assertEqual(store.depth, hashdir_depth(100))
+        store.put('key', b'data')
+        # reopened without expected_keys, the recorded depth is still used
+        reopened = HashdirStore(self.root)
+        self.assertEqual(reopened.depth, store.depth)
+        self.assertEqual(reopened.get('key'), b'data')
+        with self.assertRaises(ValueError):
+            HashdirStore(self.root, depth=store.depth + 1)
+
+    def test_expected_keys_for_populated_root(self):
+        HashdirStore(self.root).put('key', b'data')
+        with self.assertRaises(ValueError):
+            HashdirStore(self.root, expected_keys=100)
+        self.assertFalse(os.path.exists(os.path.join(self.root, DEPTH_FILE)))
+
+    def test_depth_and_expected_keys(self):
+        with self.assertRaises(ValueError):
+            HashdirStore(self.root, depth=2, expected_keys=100)
+
+
+if __name__ == '__main__':
+    unittest.main()
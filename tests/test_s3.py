@@ -0,0 +1,142 @@
+import io
+import sys
+import unittest
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+import boto3
+
+from botocore.stub import Stubber, ANY
+from botocore.response import StreamingBody
+from aiobotocore.session import get_session
+from aiobotocore.stub import AioStubber
+
+from storage.s3 import BucketStore, AsyncBucketStore
+
+
+def body(data):
+    """ a streaming response body for a stubbed get_object """
+    return StreamingBody(io.BytesIO(data), len(data))
+
+
+class AsyncBody:
+    """ a minimal aiobotocore response body for a stubbed get_object """
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+        self.closed = False
+
+    async def read(self, amt=None):
+        return self.stream.read(amt)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.closed = True
+
+
+class TestBucketStore(unittest.TestCase):
+    def setUp(self):
+        client = boto3.client('s3', region_name='us-east-1',
+            aws_access_key_id='test', aws_secret_access_key='test')
+        self.stubber = Stubber(client)
+        self.stubber.activate()
+        self.store = BucketStore(None, None, None, 'bucket', s3_client=client, multipart_chunksize=10)
+        self.store.open()
+
+    def tearDown(self):
+        self.store.close()
+        self.stubber.deactivate()
+
+    def test_put_file_object(self):
+        self.stubber.add_response('put_object', {}, {'Bucket': 'bucket', 'Key': 'key', 'Body': ANY,
+            'ChecksumAlgorithm': ANY})
+        self.store.put('key', io.BytesIO(b'file data'))
+        self.stubber.assert_no_pending_responses()
+
+    def test_put_file_object_without_open(self):
+        store = BucketStore(None, None, None, 'bucket', s3_client=self.store.s3_client)
+        self.stubber.add_response('put_object', {}, {'Bucket': 'bucket', 'Key': 'key', 'Body': ANY,
+            'ChecksumAlgorithm': ANY})
+        store.put('key', io.BytesIO(b'file data'))
+        store.close()
+        store.close()
+        self.stubber.assert_no_pending_responses()
+
+    def test_get_types(self):
+        self.stubber.add_response('get_object', {'Body': body(b'small'), 'ContentLength': 5,
+            'ContentRange': 'bytes 0-4/5', 'ETag': '"e"'})
+        self.assertEqual(self.store.get('small'), b'small')
+        data = bytes(range(15))
+        self.stubber.add_response('get_object', {'Body': body(data[:10]), 'ContentLength': 10,
+            'ContentRange': 'bytes 0-9/15', 'ETag': '"e"'})
+        self.stubber.add_response('get_object', {'Body': body(data[10:]), 'ContentLength': 5,
+            'ContentRange': 'bytes 10-14/15', 'ETag': '"e"'},
+            {'Bucket': 'bucket', 'Key': 'large', 'Range': 'bytes=10-14', 'IfMatch': '"e"'})
+        large = self.store.get('large')
+        self.assertIsInstance(large, bytearray)
+        self.assertEqual(large, data)
+
+
+class TestAsyncBucketStoreMultipart(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        session = get_session()
+        self.client_context = session.create_client('s3', region_name='us-east-1',
+            aws_access_key_id='test', aws_secret_access_key='test')
+        self.client = await self.client_context.__aenter__()
+        self.stubber = AioStubber(self.client)
+        self.stubber.activate()
+
+    async def asyncTearDown(self):
+        self.stubber.deactivate()
+        await self.client_context.__aexit__(None, None, None)
+
+    async def test_multipart_put(self):
+        store = AsyncBucketStore(self.client, 'bucket', multipart_chunksize=10, max_concurrency=1)
+        data = bytes(range(25))
+        self.stubber.add_response('create_multipart_upload', {'UploadId': 'upload'},
+            {'Bucket': 'bucket', 'Key': 'key'})
+        for part_number, offset in enumerate(range(0, len(data), 10), 1):
+            self.stubber.add_response('upload_part', {'ETag': f'"etag{part_number}"'},
+                {'Bucket': 'bucket', 'Key': 'key', 'UploadId': 'upload',
+                 'PartNumber': part_number, 'Body': data[offset:offset+10]})
+        self.stubber.add_response('complete_multipart_upload', {},
+            {'Bucket': 'bucket', 'Key': 'key', 'UploadId': 'upload',
+             'MultipartUpload': {'Parts': [{'PartNumber': n, 'ETag': f'"etag{n}"'} for n in (1, 2, 3)]}})
+        await store.put('key', data)
+        self.stubber.assert_no_pending_responses()
+
+    async def test_multipart_put_aborts_on_error(self):
+        store = AsyncBucketStore(self.client, 'bucket', multipart_chunksize=10, max_concurrency=1)
+        self.stubber.add_response('create_multipart_upload', {'UploadId': 'upload'})
+        self.stubber.add_client_error('upload_part', 'InternalError')
+        self.stubber.add_response('abort_multipart_upload', {},
+            {'Bucket': 'bucket', 'Key': 'key', 'UploadId': 'upload'})
+        with self.assertRaises(Exception):
+            await store.put('key', bytes(15))
+        self.stubber.assert_no_pending_responses()
+
+    async def test_put_file_object(self):
+        store = AsyncBucketStore(self.client, 'bucket', multipart_chunksize=10)
+        data = io.BytesIO(bytes(15))
+        self.stubber.add_response('put_object', {}, {'Bucket': 'bucket', 'Key': 'key', 'Body': data})
+        await store.put('key', data)
+        self.stubber.assert_no_pending_responses()
+
+    async def test_multipart_get_fails_on_part_error(self):
+        store = AsyncBucketStore(self.client, 'bucket', multipart_chunksize=10)
+        first = AsyncBody(bytes(10))
+        self.stubber.add_response('get_object', {'Body': first, 'ContentLength': 10,
+            'ContentRange': 'bytes 0-9/25', 'ETag': '"e"'})
+        self.stubber.add_client_error('get_object', 'PreconditionFailed', http_status_code=412)
+        self.stubber.add_response('get_object', {'Body': AsyncBody(bytes(5)), 'ContentLength': 5,
+            'ContentRange': 'bytes 20-24/25', 'ETag': '"e"'})
+        with self.assertRaises(Exception):
+            await store.get('key')
+        self.assertTrue(first.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()